@@ -0,0 +1,101 @@
+import math
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+try:
+    from flash_attn import flash_attn_qkvpacked_func
+except ImportError:
+    flash_attn_qkvpacked_func = None
+
+TRITON_AVAILABLE = triton is not None
+
+
+if TRITON_AVAILABLE:
+
+    # head dim is fixed at 64 (d_model=512, h=8), so only the tile shape and warp count are tuned
+    @triton.autotune(
+        configs=[
+            triton.Config({'BLOCK_M':128,'BLOCK_N':64},num_warps=4,num_stages=2),
+            triton.Config({'BLOCK_M':128,'BLOCK_N':64},num_warps=8,num_stages=2),
+            triton.Config({'BLOCK_M':128,'BLOCK_N':32},num_warps=4,num_stages=3),
+            triton.Config({'BLOCK_M':64,'BLOCK_N':64},num_warps=4,num_stages=2),
+        ],
+        # keyed on power-of-two length buckets so incremental decoding does not re-tune on every token
+        key=['N_Q_BUCKET','N_K_BUCKET','CAUSAL'],
+    )
+    @triton.jit
+    def _flash_attn_fwd_kernel(Q,K,V,Out,sm_scale,
+                               stride_qb,stride_qh,stride_qm,stride_qd,
+                               stride_kb,stride_kh,stride_kn,stride_kd,
+                               stride_vb,stride_vh,stride_vn,stride_vd,
+                               stride_ob,stride_oh,stride_om,stride_od,
+                               H,N_CTX_Q,N_CTX_K,N_Q_BUCKET,N_K_BUCKET,
+                               CAUSAL:tl.constexpr,D_K:tl.constexpr,BLOCK_M:tl.constexpr,BLOCK_N:tl.constexpr):
+        start_m = tl.program_id(0)
+        off_bh = tl.program_id(1)
+        off_b = off_bh // H
+        off_h = off_bh % H
+
+        offs_m = start_m * BLOCK_M + tl.arange(0,BLOCK_M)
+        offs_n = tl.arange(0,BLOCK_N)
+        offs_d = tl.arange(0,D_K)
+
+        q_ptrs = Q + off_b*stride_qb + off_h*stride_qh + offs_m[:,None]*stride_qm + offs_d[None,:]*stride_qd
+        k_base = K + off_b*stride_kb + off_h*stride_kh
+        v_base = V + off_b*stride_vb + off_h*stride_vh
+
+        q = tl.load(q_ptrs,mask=offs_m[:,None] < N_CTX_Q,other=0.0)
+
+        # running max and softmax denominator per query row, kept in registers
+        m_i = tl.full([BLOCK_M],float('-inf'),dtype=tl.float32)
+        l_i = tl.zeros([BLOCK_M],dtype=tl.float32)
+        acc = tl.zeros([BLOCK_M,D_K],dtype=tl.float32)
+        # fold 1/sqrt(d_k) and log2(e) into one multiply so the softmax can use exp2
+        qk_scale = sm_scale * 1.44269504
+
+        # causal: key tiles entirely above the diagonal contribute nothing, so stop before them
+        if CAUSAL:
+            hi = tl.minimum((start_m + 1) * BLOCK_M,N_CTX_K)
+        else:
+            hi = N_CTX_K
+
+        for start_n in range(0,hi,BLOCK_N):
+            cols = start_n + offs_n
+            k = tl.load(k_base + cols[None,:]*stride_kn + offs_d[:,None]*stride_kd,mask=cols[None,:] < N_CTX_K,other=0.0)
+            qk = tl.dot(q,k) * qk_scale
+            qk = tl.where(cols[None,:] < N_CTX_K,qk,float('-inf'))
+            if CAUSAL:
+                qk = tl.where(offs_m[:,None] >= cols[None,:],qk,float('-inf'))
+
+            m_new = tl.maximum(m_i,tl.max(qk,1))
+            p = tl.math.exp2(qk - m_new[:,None])
+            alpha = tl.math.exp2(m_i - m_new)
+            l_i = l_i * alpha + tl.sum(p,1)
+            acc = acc * alpha[:,None]
+
+            v = tl.load(v_base + cols[:,None]*stride_vn + offs_d[None,:]*stride_vd,mask=cols[:,None] < N_CTX_K,other=0.0)
+            acc += tl.dot(p.to(v.dtype),v)
+            m_i = m_new
+
+        acc = acc / l_i[:,None]
+        o_ptrs = Out + off_b*stride_ob + off_h*stride_oh + offs_m[:,None]*stride_om + offs_d[None,:]*stride_od
+        tl.store(o_ptrs,acc.to(Out.dtype.element_ty),mask=offs_m[:,None] < N_CTX_Q)
+
+
+def flash_attn_fwd_hd64(q,k,v,causal=False):
+    # q, k, v: (B, h, N, 64) fp16/bf16 on cuda. forward only: no dropout, no autograd
+    B,H,N_q,d_k = q.shape
+    assert d_k == 64 , "flash_attn_fwd_hd64 only handles a head dim of 64"
+    # written as (B, N, h, d_k) and returned as a (B, h, N, d_k) view, so merging heads afterwards is free
+    out = torch.empty(B,N_q,H,d_k,device=q.device,dtype=q.dtype).transpose(1,2)
+    grid = lambda meta: (triton.cdiv(N_q,meta['BLOCK_M']),B*H)
+    _flash_attn_fwd_kernel[grid](q,k,v,out,1 / math.sqrt(d_k),
+                                 *q.stride(),*k.stride(),*v.stride(),*out.stride(),
+                                 H,N_q,k.shape[2],triton.next_power_of_2(N_q),triton.next_power_of_2(k.shape[2]),
+                                 CAUSAL=causal,D_K=d_k)
+    return out
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import math
+from flash_attention import TRITON_AVAILABLE,flash_attn_fwd_hd64,flash_attn_qkvpacked_func
 
 class InputEmbeddings(nn.Module):
 
@@ -8,10 +10,17 @@ class InputEmbeddings(nn.Module):
         super().__init__()
         self.d_model = d_model
         self.vocab_size = vocab_size
-        self.embedding = nn.Embedding(vocab_size,d_model)
+        self.embedding = nn.utils.skip_init(nn.Embedding,vocab_size,d_model,device=torch.get_default_device())
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # fold the sqrt(d_model) scale into the weights once instead of rescaling every forward
+        nn.init.normal_(self.embedding.weight,mean=0.0,std=self.d_model ** -0.5)
+        with torch.no_grad():
+            self.embedding.weight.mul_(math.sqrt(self.d_model))
 
     def forward(self,x):
-        return self.embedding(x) * math.sqrt(self.d_model)
+        return self.embedding(x)
 
 class PositionalEncoding(nn.Module):
 
@@ -19,24 +28,23 @@ class PositionalEncoding(nn.Module):
         super().__init__()
         self.d_model=d_model
         self.seq_len = seq_len
-        self.dropout = dropout
+        self.dropout_p = float(dropout)
 
         # create a positional encoding
-        pe = torch.zeros(seq_len,d_model)
-
         position  = torch.arange(0,seq_len,dtype=torch.float).unsqueeze(1)
         div_term = torch.exp(torch.arange(0,d_model,2).float() * (-math.log(10000.0)/d_model))
+        angles = position * div_term
 
-        pe[:,0::2] = torch.sin(position*div_term)
-        pe[:,1::2] = torch.cos(position*div_term)
+        # interleave sin/cos into even/odd columns in one contiguous write
+        pe = torch.stack([angles.sin(),angles.cos()],dim=-1).flatten(1)
 
         pe = pe.unsqueeze(0)
 
-        self.register_buffer('pe',pe)
+        # not persistent: it is rebuilt in __init__, and module.to(dtype) casts it along with the weights
+        self.register_buffer('pe',pe,persistent=False)
     
-    def forward(self,x):
-        x = x + (self.pe[:,:x.shape(1),:]).requires_grad_(False)
-        return self.dropout(x)
+    def forward(self,x,start_pos=0):
+        return F.dropout(x + self.pe[:,start_pos:start_pos + x.size(1)],p=self.dropout_p,training=self.training)
 
 class LayerNormalization(nn.Module):
     
@@ -44,13 +52,17 @@ class LayerNormalization(nn.Module):
         super().__init__()
         self.d_model = d_model
         self.eps = eps
-        self.alpha = nn.Parameter(torch.ones(d_model))
-        self.beta = nn.Parameter(torch.zeros(d_model))
+        self.ln = nn.LayerNorm(d_model,eps=eps)
+
+    def _load_from_state_dict(self,state_dict,prefix,*args,**kwargs):
+        # older checkpoints store the affine params as alpha/beta
+        for old,new in (('alpha','weight'),('beta','bias')):
+            if prefix + old in state_dict:
+                state_dict[prefix + 'ln.' + new] = state_dict.pop(prefix + old)
+        super()._load_from_state_dict(state_dict,prefix,*args,**kwargs)
 
     def forward(self,x):
-        mean = x.mean(dim=-1,keepdim=True)
-        std = x.std(dim=-1,keepdim=True)
-        return self.alpha * (x - mean) / (std + self.eps) + self.beta
+        return self.ln(x)
 
 class FeedForward(nn.Module):
 
@@ -58,13 +70,20 @@ class FeedForward(nn.Module):
         super().__init__()
         self.d_model = d_model
         self.d_ff = d_ff
-        self.dropout = dropout
-        self.linear1 = nn.Linear(d_model,d_ff)
-        self.linear2 = nn.Linear(d_ff,d_model)
-        self.relu = nn.ReLU()
+        self.dropout_p = float(dropout)
+        self.linear1 = nn.utils.skip_init(nn.Linear,d_model,d_ff,device=torch.get_default_device())
+        self.linear2 = nn.utils.skip_init(nn.Linear,d_ff,d_model,device=torch.get_default_device())
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        nn.init.xavier_uniform_(self.linear1.weight,gain=nn.init.calculate_gain('relu'))
+        nn.init.zeros_(self.linear1.bias)
+        nn.init.xavier_uniform_(self.linear2.weight)
+        nn.init.zeros_(self.linear2.bias)
 
     def forward(self,x):
-        return self.linear2(self.dropout(self.relu(self.linear1(x))))
+        # bias + relu + dropout stay functional so inductor can fuse them into linear1's epilogue
+        return self.linear2(F.dropout(F.relu(self.linear1(x)),p=self.dropout_p,training=self.training))
 
 class MultiHeadAttention(nn.Module):
     def __init__(self,d_model,h,dropout):
@@ -74,125 +93,319 @@ class MultiHeadAttention(nn.Module):
         assert d_model % h == 0 , "d_model is not divisible by h"
 
         self.d_k = d_model // h
-        self.w_q = nn.Linear(d_model,d_model) 
-        self.w_k = nn.Linear(d_model,d_model)
-        self.w_v = nn.Linear(d_model,d_model)
-
-        self.w_o = nn.Linear(d_model,d_model)
-        self.dropout = nn.Dropout(dropout)
+        # q, k and v projections packed into one weight: rows [0:d), [d:2d), [2d:3d).
+        # no biases: the input is layer-normed just before, and w_o's output feeds the residual add directly
+        self.w_qkv = nn.utils.skip_init(nn.Linear,d_model,3*d_model,bias=False,device=torch.get_default_device())
+        self.w_o = nn.utils.skip_init(nn.Linear,d_model,d_model,bias=False,device=torch.get_default_device())
+        self.dropout_p = float(dropout)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # init each qkv tile on its own so the fan matches three separate d_model x d_model linears
+        for w in self.w_qkv.weight.data.chunk(3,dim=0):
+            nn.init.xavier_uniform_(w)
+        nn.init.xavier_uniform_(self.w_o.weight)
+
+    def project_qkv(self,q,k,v):
+        # cross-attention / distinct inputs; self-attention goes through pack_qkv in forward
+        w_q,w_kv = self.w_qkv.weight.split([self.d_model,2*self.d_model],dim=0)
+        query = F.linear(q,w_q)
+        if k is v:
+            key,value = F.linear(k,w_kv).chunk(2,dim=-1)
+        else:
+            w_k,w_v = w_kv.chunk(2,dim=0)
+            key,value = F.linear(k,w_k),F.linear(v,w_v)
+        return query,key,value
 
     @staticmethod
-    def attention(query,key,value,mask=None,dropout=None):
+    def attention(query,key,value,mask=None,dropout_p=0.0):
         d_k = query.shape[-1]
 
         attention_scores = torch.matmul(query,key.transpose(-2,-1)) / math.sqrt(d_k)
         if mask is not None:
-            attention_scores = attention_scores.masked_fill(mask == 0,-1e9)
+            if mask.is_floating_point():
+                # additive mask: 0 where allowed, -inf where masked
+                attention_scores = attention_scores + mask
+            else:
+                # dtype's own min rather than -1e9, which overflows fp16 scores under autocast
+                attention_scores = attention_scores.masked_fill(mask == 0,torch.finfo(attention_scores.dtype).min)
         attention_scores = torch.softmax(attention_scores,dim=-1)
-        if dropout is not None:
-            attention_scores = dropout(attention_scores)
+        if dropout_p > 0:
+            attention_scores = F.dropout(attention_scores,p=dropout_p)
 
         return torch.matmul(attention_scores,value), attention_scores
 
-    def forward(self,q,k,v,mask=None):
-        query = self.w_q(q)
-        key = self.w_k(k)
-        value = self.w_v(v)
-
-        query = query.view(query.shape[0],-1,self.h,self.d_k).transpose(1,2)
-        key = key.view(key.shape[0],-1,self.h,self.d_k).transpose(1,2)
-        value = value.view(value.shape[0],-1,self.h,self.d_k).transpose(1,2)
-
-        x , self.attention_scores = MultiHeadAttention.attention(query,key,value,mask,self.dropout)
-
-        x = x.transpose(1,2).contiguous().view(x.shape[0],-1,self.d_model)
+    def pack_qkv(self,x):
+        # (B, N, 3, h, d_k): q, k and v share one allocation with contiguous (h, d_k) inner dims
+        return self.w_qkv(x).view(x.shape[0],-1,3,self.h,self.d_k)
+
+    def split_heads(self,x):
+        # (B, N, d_model) -> (B, h, N, d_k)
+        return x.view(x.shape[0],-1,self.h,self.d_k).transpose(1,2)
+
+    def project_kv(self,kv):
+        # k/v for cross-attention, already split into heads so they can be reused across decode steps
+        key,value = F.linear(kv,self.w_qkv.weight[self.d_model:]).chunk(2,dim=-1)
+        return self.split_heads(key),self.split_heads(value)
+
+    def attend(self,query,key,value,mask=None,need_weights=False,is_causal=False):
+        # is_causal only promises that mask is the plain causal mask, so the tuned kernel can skip loading it
+        dropout_p = self.dropout_p if self.training else 0.0
+        # fp16/bf16 only: fp32 inputs would go through tl.dot as tf32 and lose precision against SDPA
+        use_flash_kernel = (TRITON_AVAILABLE and self.d_k == 64 and query.is_cuda and query.dtype in (torch.float16,torch.bfloat16)
+                            and not need_weights and not torch.is_grad_enabled() and dropout_p == 0.0
+                            and (mask is None or is_causal))
+
+        if use_flash_kernel:
+            x = flash_attn_fwd_hd64(query,key,value,causal=is_causal)
+        elif need_weights:
+            # the fused kernel never materializes the scores, so fall back to the explicit path
+            x , attention_scores = MultiHeadAttention.attention(query,key,value,mask,dropout_p)
+            if not torch.compiler.is_compiling():
+                # storing on self is a side effect dynamo would break the graph on
+                self.attention_scores = attention_scores
+        elif is_causal and query.size(2) == key.size(2):
+            # any attn_mask rules out SDPA's flash backend, so let it apply the causal mask itself
+            x = F.scaled_dot_product_attention(query,key,value,attn_mask=None,dropout_p=dropout_p,is_causal=True)
+        else:
+            # additive float masks go straight through; SDPA boolean masks mark the positions that may be attended to (True = keep)
+            attn_mask = mask
+            if mask is not None and not mask.is_floating_point():
+                attn_mask = mask != 0
+            x = F.scaled_dot_product_attention(query,key,value,attn_mask=attn_mask,dropout_p=dropout_p,is_causal=False)
+
+        # the flash backend already returns a (B, N, h, d_k) layout behind the transpose, so this is a view there
+        x = x.transpose(1,2).reshape(x.shape[0],-1,self.d_model)
 
         return self.w_o(x)
 
+    def forward(self,q,k,v,mask=None,need_weights=False,is_causal=False):
+        if q is k and k is v:
+            qkv = self.pack_qkv(q)
+            use_packed_kernel = (flash_attn_qkvpacked_func is not None and qkv.is_cuda and qkv.dtype in (torch.float16,torch.bfloat16)
+                                 and not need_weights and (mask is None or is_causal))
+            if use_packed_kernel:
+                x = flash_attn_qkvpacked_func(qkv,self.dropout_p if self.training else 0.0,causal=is_causal)
+                return self.w_o(x.reshape(x.shape[0],-1,self.d_model))
+            query,key,value = (t.transpose(1,2) for t in qkv.unbind(dim=2))
+            return self.attend(query,key,value,mask,need_weights,is_causal)
+
+        query,key,value = self.project_qkv(q,k,v)
+        return self.attend(self.split_heads(query),self.split_heads(key),self.split_heads(value),mask,need_weights,is_causal)
+
+    def forward_with_cached_kv(self,q,k_cached,v_cached,mask=None):
+        query = F.linear(q,self.w_qkv.weight[:self.d_model])
+        return self.attend(self.split_heads(query),k_cached,v_cached,mask)
+
+    def forward_self_cached(self,x,cache,mask=None,is_causal=False):
+        # incremental self-attention: append this step's k/v to cache['k']/cache['v'] and attend over all of them
+        query,key,value = (t.transpose(1,2) for t in self.pack_qkv(x).unbind(dim=2))
+        if 'k' in cache:
+            key = torch.cat([cache['k'],key],dim=2)
+            value = torch.cat([cache['v'],value],dim=2)
+        cache['k'],cache['v'] = key,value
+        return self.attend(query,key,value,mask,is_causal=is_causal)
+
+def dropout_add(residual,x,p,training):
+    # kept as one expression so inductor fuses dropout + add into the epilogue of the gemm producing x
+    return residual + F.dropout(x,p=p,training=training)
+
 class ResidualConnection(nn.Module):
 
     def __init__(self,d_model,dropout):
         super().__init__()
         self.d_model = d_model
-        self.dropout = dropout
+        self.dropout_p = float(dropout)
         self.norm = LayerNormalization(d_model)
-        self.dropout = nn.Dropout(dropout)
 
     def forward(self,x,sublayer):
-        return x + self.dropout(sublayer(self.norm(x))) 
+        # normalize once; the sublayer gets the same tensor for q, k and v so it takes the fused qkv path
+        normed = self.norm(x)
+        return dropout_add(x,sublayer(normed),self.dropout_p,self.training)
 
 class EncoderLayer(nn.Module):
     
-    def __init__(self,d_model,h,d_ff,dropout):
+    def __init__(self,d_model,self_attention_block,feed_forward_block,dropout):
         super().__init__()
         self.d_model = d_model
-        self.h = h
-        self.d_ff = d_ff
-        self.dropout = dropout
+        self.dropout_p = float(dropout)
 
-        self.multi_head_attention = MultiHeadAttention(d_model,h,dropout)
-        self.feed_forward = FeedForward(d_model,d_ff,dropout)
+        self.multi_head_attention = self_attention_block
+        self.feed_forward = feed_forward_block
         self.residual_connection = ResidualConnection(d_model,dropout)
         self.residual_connection_ff = ResidualConnection(d_model,dropout)
 
     def forward(self,x,mask):
-        x = self.residual_connection(x,lambda x: self.multi_head_attention(x,x,x,mask))
-        x = self.residual_connection_ff(x,lambda x: self.feed_forward(x))
+        x = self.residual_connection(x,lambda n: self.multi_head_attention(n,n,n,mask))
+        x = self.residual_connection_ff(x,self.feed_forward)
         return x
 
 class Encoder(nn.Module):
 
-    def __init__(self,layers:nn.ModuleList):
+    def __init__(self,d_model,layers:nn.ModuleList):
         super().__init__()
         self.layers = layers
-        self.norm = LayerNormalization()
+        self.norm = LayerNormalization(d_model)
         
     def forward(self,x,mask):
-        for layer in self.encoder_layers:
+        for layer in self.layers:
             x = layer(x,mask)
         return self.norm(x)
 
+class StackedEncoder(nn.Module):
+    # same computation as Encoder over N EncoderLayers, but every per-layer weight lives in one
+    # (N, out, in) tensor so the loop is plain F.linear calls with static storage, which suits
+    # cuda graph capture (compile_mode="reduce-overhead")
+
+    def __init__(self,d_model,h,d_ff,N,dropout,eps=1e-6):
+        super().__init__()
+        assert d_model % h == 0 , "d_model is not divisible by h"
+        self.d_model = d_model
+        self.h = h
+        self.d_k = d_model // h
+        self.d_ff = d_ff
+        self.N = N
+        self.eps = eps
+        self.dropout_p = float(dropout)
+
+        self.w_qkv = nn.Parameter(torch.empty(N,3*d_model,d_model))
+        self.w_o = nn.Parameter(torch.empty(N,d_model,d_model))
+        self.w_ff1 = nn.Parameter(torch.empty(N,d_ff,d_model))
+        self.b_ff1 = nn.Parameter(torch.empty(N,d_ff))
+        self.w_ff2 = nn.Parameter(torch.empty(N,d_model,d_ff))
+        self.b_ff2 = nn.Parameter(torch.empty(N,d_model))
+        self.norm_attn_weight = nn.Parameter(torch.ones(N,d_model))
+        self.norm_attn_bias = nn.Parameter(torch.zeros(N,d_model))
+        self.norm_ff_weight = nn.Parameter(torch.ones(N,d_model))
+        self.norm_ff_bias = nn.Parameter(torch.zeros(N,d_model))
+        self.norm = LayerNormalization(d_model)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # per layer, per tile init so each slice matches the FeedForward/MultiHeadAttention init it replaces
+        with torch.no_grad():
+            for i in range(self.N):
+                for w in self.w_qkv[i].chunk(3,dim=0):
+                    nn.init.xavier_uniform_(w)
+                nn.init.xavier_uniform_(self.w_o[i])
+                nn.init.xavier_uniform_(self.w_ff1[i],gain=nn.init.calculate_gain('relu'))
+                nn.init.xavier_uniform_(self.w_ff2[i])
+            self.b_ff1.zero_()
+            self.b_ff2.zero_()
+            self.norm_attn_weight.fill_(1.0)
+            self.norm_attn_bias.zero_()
+            self.norm_ff_weight.fill_(1.0)
+            self.norm_ff_bias.zero_()
+
+    def layer(self,x,i,attn_mask):
+        B = x.shape[0]
+
+        n = F.layer_norm(x,(self.d_model,),self.norm_attn_weight[i],self.norm_attn_bias[i],self.eps)
+        query,key,value = F.linear(n,self.w_qkv[i]).view(B,-1,3,self.h,self.d_k).permute(2,0,3,1,4)
+        a = F.scaled_dot_product_attention(query,key,value,attn_mask=attn_mask,dropout_p=self.dropout_p if self.training else 0.0)
+        a = a.transpose(1,2).reshape(B,-1,self.d_model)
+        x = dropout_add(x,F.linear(a,self.w_o[i]),self.dropout_p,self.training)
+
+        n = F.layer_norm(x,(self.d_model,),self.norm_ff_weight[i],self.norm_ff_bias[i],self.eps)
+        f = F.dropout(F.relu(F.linear(n,self.w_ff1[i],self.b_ff1[i])),p=self.dropout_p,training=self.training)
+        return dropout_add(x,F.linear(f,self.w_ff2[i],self.b_ff2[i]),self.dropout_p,self.training)
+
+    def forward(self,x,mask):
+        # same rule as MultiHeadAttention.attend: float masks are additive, int/bool masks mark positions to keep
+        attn_mask = mask
+        if mask is not None and not mask.is_floating_point():
+            attn_mask = mask != 0
+        for i in range(self.N):
+            x = self.layer(x,i,attn_mask)
+        return self.norm(x)
+
 class DecoderLayer(nn.Module):
 
-    def __init__(self,self_attention_block,cross_attention_block,feed_forward_block,dropout):
+    def __init__(self,d_model,self_attention_block,cross_attention_block,feed_forward_block,dropout):
         super().__init__()
+        self.d_model = d_model
         self.self_attention_block = self_attention_block
         self.cross_attention_block = cross_attention_block
         self.feed_forward_block = feed_forward_block
-        self.residual_connections = ResidualConnection(d_model,dropout)
+        # one pre-norm per sublayer, each with its own gamma/beta
+        self.res1 = ResidualConnection(d_model,dropout)
+        self.res2 = ResidualConnection(d_model,dropout)
+        self.res3 = ResidualConnection(d_model,dropout)
+
+    def forward(self,x,enc_output,src_mask,tgt_mask,is_causal=False):
+        x = self.res1(x,lambda n: self.self_attention_block(n,n,n,tgt_mask,is_causal=is_causal))
+        x = self.res2(x,lambda n: self.cross_attention_block(n,enc_output,enc_output,src_mask))
+        x = self.res3(x,self.feed_forward_block)
+        return x
 
-    def forward(self,x,enc_output,src_mask,tgt_mask):
-        x = self.residual_connections(x,lambda x: self.self_attention_block(x,x,x,tgt_mask))
-        x = self.residual_connections(x,lambda x: self.cross_attention_block(x,enc_output,enc_output,src_mask))
-        x = self.residual_connections(x,lambda x: self.feed_forward_block(x))
+    def forward_cached(self,x,cache,src_mask,tgt_mask,is_causal=False):
+        x = self.res1(x,lambda n: self.self_attention_block.forward_self_cached(n,cache,tgt_mask,is_causal=is_causal))
+        x = self.res2(x,lambda n: self.cross_attention_block.forward_with_cached_kv(n,*cache['cross_kv'],src_mask))
+        x = self.res3(x,self.feed_forward_block)
         return x
 
 class Decoder(nn.Module):
     
-    def __init__(self,layers:nn.ModuleList):
+    def __init__(self,d_model,layers:nn.ModuleList,seq_len):
         super().__init__()
         self.layers = layers
-        self.norm = LayerNormalization()
+        self.norm = LayerNormalization(d_model)
+        # additive causal mask built once, for the explicit need_weights path and offset rows of cached decoding;
+        # plain causal self-attention hands is_causal to the kernels instead. follows the module's dtype
+        self.register_buffer('causal_mask',torch.triu(torch.full((seq_len,seq_len),float('-inf')),diagonal=1),persistent=False)
         
-    def forward(self,x,enc_output,src_mask,tgt_mask):
+    def forward(self,x,enc_output,src_mask,tgt_mask=None):
+        is_causal = tgt_mask is None
+        if is_causal:
+            # targets are right-padded, so the causal mask alone already keeps real tokens off the padding
+            tgt_mask = self.causal_mask[:x.size(1),:x.size(1)]
         for layer in self.layers:
-            x = layer(x,enc_output,src_mask,tgt_mask)
+            x = layer(x,enc_output,src_mask,tgt_mask,is_causal)
+        return self.norm(x)
+
+    def build_cache(self,enc_output):
+        # the encoder output is fixed for the whole decode, so project each layer's cross-attention k/v once
+        return {'pos':0,'layers':[{'cross_kv':layer.cross_attention_block.project_kv(enc_output)} for layer in self.layers]}
+
+    def forward_cached(self,x,cache,src_mask):
+        start,end = cache['pos'],cache['pos'] + x.size(1)
+        if end > self.causal_mask.size(0):
+            raise ValueError(f'Cannot decode past position {self.causal_mask.size(0)} (tgt_seq_len), got {end}')
+        # a single new token may attend to everything cached so far, so it needs no mask
+        tgt_mask = self.causal_mask[start:end,:end] if x.size(1) > 1 else None
+        is_causal = start == 0 and tgt_mask is not None
+        for layer,layer_cache in zip(self.layers,cache['layers']):
+            x = layer.forward_cached(x,layer_cache,src_mask,tgt_mask,is_causal)
+        cache['pos'] = end
         return self.norm(x)
 
 class ProjectionLayer(nn.Module):
 
-    def __init__(self,d_model,vocab_size):
+    def __init__(self,d_model,vocab_size,tied_embedding=None):
         super().__init__()
         self.d_model = d_model
         self.vocab_size = vocab_size
-        self.linear = nn.Linear(d_model,vocab_size)
+        self.scale = None
+        if tied_embedding is not None:
+            # share the target embedding matrix, already initialized there; it is stored prescaled by sqrt(d_model), so undo that here
+            self.linear = nn.Linear(d_model,vocab_size,device='meta')
+            self.linear.weight = tied_embedding.weight
+            self.linear.bias = nn.Parameter(torch.zeros(vocab_size,device=tied_embedding.weight.device))
+            self.scale = 1 / math.sqrt(d_model)
+        else:
+            self.linear = nn.utils.skip_init(nn.Linear,d_model,vocab_size,device=torch.get_default_device())
+            nn.init.xavier_uniform_(self.linear.weight)
+            nn.init.zeros_(self.linear.bias)
 
     def forward(self,x):
-        return torch.log_softmax(self.linear(x),dim=-1)
+        if self.scale is not None:
+            x = x * self.scale
+        # raw logits: cross_entropy fuses log_softmax + nll, and decoding only needs argmax
+        return self.linear(x)
 
 class Transformer(nn.Module):
 
-    def __init__(self,encoder,decoder,src_embed,tgt_embed,src_pos,tgt_pos,projection_layer):
+    def __init__(self,encoder,decoder,src_embed,tgt_embed,src_pos,tgt_pos,projection_layer,autocast_dtype=None):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
@@ -201,49 +414,78 @@ class Transformer(nn.Module):
         self.src_pos = src_pos
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
+        self.autocast_dtype = autocast_dtype
 
-    def encode(self,src,src_mask):
-        src = self.src_embed(src)
-        src = self.src_pos(src)
-        return self.encoder(src,src_mask)
+    def autocast(self,x):
+        # matmuls run in autocast_dtype, softmax/layernorm stay in fp32; no-op when autocast_dtype is None
+        return torch.autocast(x.device.type,dtype=self.autocast_dtype,enabled=self.autocast_dtype is not None)
 
-    def decode(self,encoder_output,src_mask,tgt,tgt_mask):
-        tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt,encoder_output,src_mask,tgt_mask)
+    def encode(self,src,src_mask):
+        with self.autocast(src):
+            src = self.src_embed(src)
+            src = self.src_pos(src)
+            return self.encoder(src,src_mask)
+
+    def init_decode_cache(self,encoder_output):
+        with self.autocast(encoder_output):
+            return self.decoder.build_cache(encoder_output)
+
+    def decode(self,encoder_output,src_mask,tgt,tgt_mask=None):
+        with self.autocast(tgt):
+            tgt = self.tgt_embed(tgt)
+            tgt = self.tgt_pos(tgt)
+            return self.decoder(tgt,encoder_output,src_mask,tgt_mask)
+
+    def decode_step(self,src_mask,tgt,cache):
+        # tgt holds only the new tokens; the cache from init_decode_cache is updated in place.
+        # kept separate from decode so build_transformer's static-shape compile never sees the growing cache
+        with self.autocast(tgt):
+            tgt = self.tgt_embed(tgt)
+            tgt = self.tgt_pos(tgt,cache['pos'])
+            return self.decoder.forward_cached(tgt,cache,src_mask)
 
     def project(self,x):
-        return self.projection_layer(x)
+        with self.autocast(x):
+            return self.projection_layer(x)
 
 
-def build_transformer(src_vocab_size,tgt_vocab_size,d_model,h,d_ff,N,dropout,src_seq_len,tgt_seq_len):
+def build_transformer(src_vocab_size,tgt_vocab_size,d_model,h,d_ff,N,dropout,src_seq_len,tgt_seq_len,compile:bool=False,compile_mode:str="reduce-overhead",autocast_dtype=None,stacked_encoder:bool=False,tie_weights:bool=True):
     src_embed = InputEmbeddings(d_model,src_vocab_size)
     tgt_embed = InputEmbeddings(d_model,tgt_vocab_size)
-    src_pos = PositionalEncoding(d_model,src_seq_len,dropout)
-    tgt_pos = PositionalEncoding(d_model,tgt_seq_len,dropout)
+    # forward slices pe to the input length, so one table sized for the longer side serves both
+    src_pos = PositionalEncoding(d_model,max(src_seq_len,tgt_seq_len),dropout)
+    tgt_pos = src_pos
  
-    encoder_block = []
-    for _ in range(N):
-        encoder_self_attention_block = MultiHeadAttention(d_model,h,dropout)
-        feed_forward_block = FeedForward(d_model,d_ff,dropout)
-        encoder_block.append(EncoderLayer(d_model,h,d_ff,dropout))
+    if stacked_encoder:
+        encoder = StackedEncoder(d_model,h,d_ff,N,dropout)
+    else:
+        encoder_block = []
+        for _ in range(N):
+            encoder_self_attention_block = MultiHeadAttention(d_model,h,dropout)
+            feed_forward_block = FeedForward(d_model,d_ff,dropout)
+            encoder_block.append(EncoderLayer(d_model,encoder_self_attention_block,feed_forward_block,dropout))
+        encoder = Encoder(d_model,nn.ModuleList(encoder_block))
 
     decoder_block = []
     for _ in range(N):
         decoder_self_attention_block = MultiHeadAttention(d_model,h,dropout)
         decoder_cross_attention_block = MultiHeadAttention(d_model,h,dropout)
         feed_forward_block = FeedForward(d_model,d_ff,dropout)
-        decoder_block.append(DecoderLayer(decoder_self_attention_block,decoder_cross_attention_block,feed_forward_block,dropout))
+        decoder_block.append(DecoderLayer(d_model,decoder_self_attention_block,decoder_cross_attention_block,feed_forward_block,dropout))
 
-    encoder = Encoder(nn.ModuleList(encoder_block))
-    decoder = Decoder(nn.ModuleList(decoder_block))
-    projection_layer = ProjectionLayer(d_model,tgt_vocab_size)
+    decoder = Decoder(d_model,nn.ModuleList(decoder_block),tgt_seq_len)
+    projection_layer = ProjectionLayer(d_model,tgt_vocab_size,tgt_embed.embedding if tie_weights else None)
 
-    transformer = Transformer(encoder,decoder,src_embed,tgt_embed,src_pos,tgt_pos,projection_layer)
+    # every module initializes its own parameters in __init__, so there is no global re-init pass here
+    transformer = Transformer(encoder,decoder,src_embed,tgt_embed,src_pos,tgt_pos,projection_layer,autocast_dtype)
 
-    for p in transformer.parameters():
-        if p.dim() > 1:
-            nn.init.xavier_uniform_(p)
+    if compile:
+        # Transformer has no forward, so compile the entry points the training loop calls.
+        # inputs are padded to src_seq_len/tgt_seq_len, so static shapes avoid recompiles;
+        # decode_step stays eager since the cache grows every step
+        transformer.encode = torch.compile(transformer.encode,mode=compile_mode,dynamic=False)
+        transformer.decode = torch.compile(transformer.decode,mode=compile_mode,dynamic=False)
+        transformer.project = torch.compile(transformer.project,mode=compile_mode,dynamic=False)
 
     return transformer
 
@@ -96,16 +96,17 @@ def train_model(config):
             encoder_input = batch['encoder_input'].to(device)
             decoder_input = batch['decoder_input'].to(device)
             encoder_mask = batch['encoder_mask'].to(device)
-            decoder_mask = batch['decoder_mask'].to(device)
 
             encoder_output = model.encode(encoder_input,encoder_mask)
-            decoder_output = model.decode(encoder_output,encoder_mask,decoder_input,decoder_mask)
+            # the decoder applies its prebuilt causal mask when no tgt_mask is given
+            decoder_output = model.decode(encoder_output,encoder_mask,decoder_input)
 
             proj_output = model.project(decoder_output)
 
             label = batch['label'].to(device)
 
-            loss = loss_fn(proj_output.view(-1,tokenizer_tgt.get_vocab_size(-1)))
+            # project() returns autocast-dtype logits; upcast so log_softmax + label-smoothed nll run in fp32
+            loss = loss_fn(proj_output.float().view(-1,tokenizer_tgt.get_vocab_size()),label.view(-1))
 
             batch_iterator.set_postfix({f"loss":f"{loss.item():.4f}"})
 